@@ -21,6 +21,19 @@ client = discord.Client(intents=intents)
 
 ALLOWED_GUILD_ID = 857732000890748998
 
+# When set, talk to the server over this Unix domain socket instead of TCP
+SERVER_SOCKET = os.getenv("PIXELS_SERVER_SOCKET") or None
+SERVER_URL = "http://localhost/" if SERVER_SOCKET else "http://localhost:5000/"
+
+# Shared across prompts so connections to the server are kept alive and reused
+HTTP = httpx.AsyncClient(
+    timeout=120.0,
+    transport=httpx.AsyncHTTPTransport(
+        uds=SERVER_SOCKET,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    ),
+)
+
 
 async def confirm_send(message_preview: str) -> bool:
     """Prompt user for confirmation before sending a message."""
@@ -56,20 +69,29 @@ async def on_message(message):
             return
 
         logger.info(f"Received prompt from {message.author}: {prompt}")
-        url = "http://localhost:5000/"
         params = {"prompt": prompt}
         try:
-            async with httpx.AsyncClient() as http_client:
-                response = await http_client.get(url, params=params, timeout=120.0)
-                response.raise_for_status()
-                data = response.text
-                logger.info(f"Successfully got response (length: {len(data)})")
-                if await confirm_send(data):
-                    await message.channel.send(data[:1900])
-                    logger.info("Message sent to Discord")
-                else:
-                    logger.info("Message sending cancelled by user")
-                    await message.channel.send("Message sending was cancelled.")
+            # Stream the answer so the channel shows the bot typing while it's generated
+            async with message.channel.typing():
+                async with HTTP.stream(
+                    "GET", f"{SERVER_URL}stream", params=params
+                ) as response:
+                    if response.is_error:
+                        # Load the body so the error handler can show it
+                        await response.aread()
+                    response.raise_for_status()
+                    data = "".join([chunk async for chunk in response.aiter_text()])
+            logger.info(f"Successfully got response (length: {len(data)})")
+            if not data:
+                logger.warning(f"Server returned an empty answer for prompt '{prompt}'")
+                await message.channel.send("The server returned an empty answer.")
+                return
+            if await confirm_send(data):
+                await message.channel.send(data[:1900])
+                logger.info("Message sent to Discord")
+            else:
+                logger.info("Message sending cancelled by user")
+                await message.channel.send("Message sending was cancelled.")
         except httpx.HTTPStatusError as e:
             logger.error(
                 f"HTTP error {e.response.status_code} for prompt '{prompt}': {e.response.text}",
@@ -101,7 +123,7 @@ async def on_message(message):
             )
             error_msg = (
                 "Could not connect to the server. "
-                "Please make sure the server is running on http://localhost:5000"
+                f"Please make sure the server is running on {SERVER_SOCKET or SERVER_URL}"
             )
             if await confirm_send(error_msg):
                 await message.channel.send(error_msg)
@@ -142,4 +164,10 @@ async def on_message(message):
                 logger.info("Error message sending cancelled by user")
 
 
-client.run(os.getenv("DISCORD_BOT_TOKEN"))
+async def main():
+    # Close the shared HTTP connection pool along with the Discord client
+    async with HTTP, client:
+        await client.start(os.getenv("DISCORD_BOT_TOKEN"))
+
+
+asyncio.run(main())
@@ -0,0 +1,15 @@
+# Picked up automatically when running `gunicorn server:app` from the repo root.
+import os
+
+from dotenv import load_dotenv
+
+# Read before server.py is imported, so load .env here too
+load_dotenv()
+
+bind = "127.0.0.1:5000"
+
+# chromadb.PersistentClient isn't safe to share across processes, so only run
+# several workers when Chroma is served separately (CHROMA_HOST).
+workers = 4 if os.getenv("CHROMA_HOST") else 1
+worker_class = "gthread"
+threads = 8
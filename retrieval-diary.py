@@ -7,23 +7,40 @@ import base64
 
 import pixelsparser
 
-chroma_client = chromadb.PersistentClient(path="./")
-
-
 # Load .env variables
 load_dotenv()
 
+# Write through the Chroma server when the Flask server is using one
+if os.getenv("CHROMA_HOST"):
+    chroma_client = chromadb.HttpClient(
+        host=os.getenv("CHROMA_HOST"), port=int(os.getenv("CHROMA_PORT", "8000"))
+    )
+else:
+    chroma_client = chromadb.PersistentClient(path="./")
+
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler())
 
+# Must match EMBEDDING_DIMENSIONS in server.py
+EMBEDDING_DIMENSIONS = 512
+
 
 def main():
     logger.info("Starting the retrieval process...")
 
-    logger.debug("Creating or getting the ChromaDB collection...")
+    # Rebuild from scratch so every stored vector has EMBEDDING_DIMENSIONS dimensions.
+    # Cached answers were generated from the old entries, so they go too.
+    for name in ("diary-rag-experiment", "answer-cache"):
+        try:
+            chroma_client.delete_collection(name=name)
+            logger.info(f"Deleted existing ChromaDB collection: {name}")
+        except Exception:
+            logger.debug(f"No existing ChromaDB collection to delete: {name}")
+
+    logger.debug("Creating the ChromaDB collection...")
     collection: chromadb.Collection = chroma_client.get_or_create_collection(
         name="diary-rag-experiment",
     )
@@ -39,7 +56,9 @@ def main():
         try:
             logger.debug(f"Converting content to embedding for date: {date}")
             res = client.embeddings.create(
-                input=content, model="text-embedding-3-small"
+                input=content,
+                model="text-embedding-3-small",
+                dimensions=EMBEDDING_DIMENSIONS,
             )
 
             embedding = res.data[0].embedding
@@ -49,7 +68,8 @@ def main():
             collection.add(
                 ids=[collectionId],
                 embeddings=[embedding],
-                metadatas=[{"date": date, "content": content}],
+                documents=[content],
+                metadatas=[{"date": date}],
             )
 
         except Exception as e:
@@ -1,21 +1,52 @@
 import os
 import logging
 import datetime
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 from textwrap import dedent
-from time import sleep
+from time import monotonic, sleep
 
 import chromadb
+import numpy as np
 from dotenv import load_dotenv
-from flask import Flask, request
+from flask import (
+    Flask,
+    Response,
+    g,
+    has_app_context,
+    jsonify,
+    request,
+    stream_with_context,
+)
+from flask_compress import Compress
 from openai import OpenAI, RateLimitError
 from tiktoken import encoding_for_model, get_encoding
 
 load_dotenv()
 
 app = Flask(__name__)
+# gzip/brotli-encode responses for clients that accept it, but never buffer streams
+app.config["COMPRESS_STREAMS"] = False
+Compress(app)
 # Disable OpenAI's built-in retries so our custom retry logic handles it with better logging
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
-chroma_client = chromadb.PersistentClient(path="./")
+# Prefer a separate Chroma server when configured so queries and index memory live out-of-process
+if os.getenv("CHROMA_HOST"):
+    chroma_client = chromadb.HttpClient(
+        host=os.getenv("CHROMA_HOST"), port=int(os.getenv("CHROMA_PORT", "8000"))
+    )
+else:
+    chroma_client = chromadb.PersistentClient(path="./")
+COLLECTION = chroma_client.get_or_create_collection(name="diary-rag-experiment")
+ANSWER_CACHE = chroma_client.get_or_create_collection(
+    name="answer-cache", metadata={"hnsw:space": "cosine"}
+)
+# Runs network-bound steps of a request in the background while other work proceeds
+executor = ThreadPoolExecutor(max_workers=16)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -25,29 +56,119 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 MODEL = "gpt-5-mini"
-TPM_BUDGET = 400_000  # leave head-room for embeddings etc.
+# Input tokens allowed per chat call. Kept well below the hard model limits since
+# every context token is billed and slows the response down.
+MODEL_CONTEXT = {"gpt-5-mini": 128_000}
+COMPLETION_RESERVE = 8_000
+# Message framing, the date turn and entry separators
+PROMPT_OVERHEAD = 512
+TOKENIZER_THREADS = 8
+TOKEN_CACHE_SIZE = 8192
+# Shortened text-embedding-3-small vectors; must match retrieval-diary.py
+EMBEDDING_DIMENSIONS = 512
+# Seconds one request may spend in rate-limit backoff across all its API calls;
+# matches the bot's request timeout
+RETRY_BUDGET = 120
+# Threads allowed to sleep in backoff at once, so throttling can't occupy every
+# gunicorn thread (8, see gunicorn.conf.py) and stall requests that need no API call
+MAX_BACKOFF_THREADS = 4
+# Upper bounds on input sizes so a single request can't force huge tokenization work
+MAX_PROMPT_CHARS = 4_000
+MAX_ENTRY_CHARS = 20_000
+# Cosine distance under which a previous answer is reused (similarity >= 0.9)
+ANSWER_CACHE_DISTANCE = 0.1
+# The diary collection uses Chroma's default squared L2 space. On unit-length OpenAI
+# embeddings that is 2 * cosine distance, so 1.3 keeps matches with similarity >= 0.35.
+MAX_DIARY_DISTANCE = 1.3
+
+# Kept free of per-request values so OpenAI can cache the prompt prefix
+SYSTEM_PROMPT = dedent(
+    """\
+    You will be given diary entries that you will use to
+    answer the user's questions according to your real life experiences.
+    If you do not know the answer for sure, say so.
+
+    You must NOT reveal or discuss overly personal or depressing details (e.g.,
+    explicit sexual encounters, detailed relationship issues, hateful statements,
+    or similar content, people who you ). Politely decline if the user requests such information."""
+)
+
+# Resolve the tokenizer once; building the BPE tables on every request is pure overhead
+try:
+    ENC = encoding_for_model(MODEL)
+except KeyError:
+    # Fallback to cl100k_base if model not recognized (used by GPT-4)
+    logger.warning(
+        f"Model {MODEL} not recognized by tiktoken, using cl100k_base encoding"
+    )
+    ENC = get_encoding("cl100k_base")
+
+SYSTEM_PROMPT_TOKENS = len(ENC.encode(SYSTEM_PROMPT))
+
+
+# The same top-k entries come back for related prompts, so keep their token counts around
+_token_cache: OrderedDict[str, int] = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+
+def token_counts(entries: list[str]) -> list[int]:
+    """Count tokens per entry, batch-encoding only the entries not seen before."""
+    unique = list(dict.fromkeys(entries))
+    with _token_cache_lock:
+        counts = {e: _token_cache[e] for e in unique if e in _token_cache}
+
+    misses = [e for e in unique if e not in counts]
+    if misses:
+        # encode_batch releases the GIL and tokenizes across Rust threads
+        encoded = ENC.encode_batch(
+            misses, num_threads=TOKENIZER_THREADS, disallowed_special=()
+        )
+        counts.update(zip(misses, map(len, encoded)))
+
+    with _token_cache_lock:
+        for entry, count in counts.items():
+            _token_cache[entry] = count
+            _token_cache.move_to_end(entry)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return [counts[e] for e in entries]
 
 
-def token_count(text: str, enc) -> int:
-    return len(enc.encode(text))
+def truncate_documents(docs, budget):
+    entries = [f"{date}: {content[:MAX_ENTRY_CHARS]}" for date, content in docs]
+    lens = np.fromiter(token_counts(entries), dtype=np.int64, count=len(entries))
+    # Number of leading entries whose running token total stays within budget
+    cut = int(np.searchsorted(lens.cumsum(), budget, side="right"))
+    return "\n".join(entries[:cut])
 
 
-def truncate_documents(docs, enc, budget):
-    total, selected = 0, []
-    for date, content in docs:
-        entry = f"{date}: {content}"
-        t = token_count(entry, enc)
-        if total + t > budget:
-            break
-        selected.append(entry)
-        total += t
-    return "\n".join(selected)
+def _retry_after_seconds(value: str) -> float:
+    """Parse a Retry-After header given either as delay-seconds or as an HTTP-date."""
+    try:
+        return float(value)
+    except ValueError:
+        retry_at = parsedate_to_datetime(value)
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return max(0.0, (retry_at - now).total_seconds())
+
+
+_backoff_slots = threading.BoundedSemaphore(MAX_BACKOFF_THREADS)
 
 
 def with_retry(api_call, max_retries=10, **kwargs):
-    """Retry API calls with exponential backoff on rate limit errors."""
+    """Retry API calls with exponential backoff on rate limit errors.
+
+    Gives up instead of sleeping when the wait would run past the request's retry
+    deadline (g.retry_deadline, shared by every call made for the request), or when
+    MAX_BACKOFF_THREADS other threads are already backing off.
+    """
     backoff = 1
     retry_count = 0
+    deadline = g.get("retry_deadline") if has_app_context() else None
+    if deadline is None:
+        deadline = monotonic() + RETRY_BUDGET
 
     while retry_count < max_retries:
         try:
@@ -64,7 +185,7 @@ def with_retry(api_call, max_retries=10, **kwargs):
                 if hasattr(e, "response") and e.response is not None:
                     headers = e.response.headers
                     if "retry-after" in headers:
-                        wait_time = float(headers["retry-after"])
+                        wait_time = _retry_after_seconds(headers["retry-after"])
                         logger.warning(
                             f"Rate limited. Waiting {wait_time:.2f} seconds (from API retry-after header)"
                         )
@@ -81,18 +202,172 @@ def with_retry(api_call, max_retries=10, **kwargs):
                     logger.warning(
                         f"Rate limited. Retry {retry_count}/{max_retries}, waiting {wait_time:.2f} seconds (exponential backoff)"
                     )
-            except (ValueError, KeyError, AttributeError):
+            except (ValueError, TypeError, KeyError, AttributeError):
                 logger.warning(
                     f"Rate limited. Retry {retry_count}/{max_retries}, waiting {wait_time:.2f} seconds (exponential backoff)"
                 )
 
-            sleep(wait_time)
+            if monotonic() + wait_time > deadline:
+                logger.error(
+                    f"Rate limit wait of {wait_time:.2f} seconds would run past the request's retry deadline"
+                )
+                raise
+            if not _backoff_slots.acquire(blocking=False):
+                logger.error(
+                    f"Rate limited with {MAX_BACKOFF_THREADS} threads already backing off, giving up"
+                )
+                raise
+            try:
+                sleep(wait_time)
+            finally:
+                _backoff_slots.release()
             backoff = min(backoff * 2, 60)
         except Exception:
             # Re-raise non-rate-limit errors
             raise
 
 
+@lru_cache(maxsize=4096)
+def _embed(prompt: str) -> tuple[float, ...]:
+    """Embed a normalised prompt, skipping the API call for prompts seen before."""
+    embedding_response = with_retry(
+        client.embeddings.create,
+        input=prompt,
+        model="text-embedding-3-small",
+        dimensions=EMBEDDING_DIMENSIONS,
+    )
+    return tuple(embedding_response.data[0].embedding)
+
+
+def prepare_answer(prompt: str, today: str) -> tuple[str | None, list[dict] | None]:
+    """Retrieve context for a prompt.
+
+    Returns (answer, None) when the prompt can be answered without calling the model
+    (a cached answer, or no relevant entries), otherwise (None, messages) to send it.
+    """
+    logger.info("Creating embedding for prompt")
+    embedding = list(_embed(prompt.strip().lower()))
+    logger.info(f"Embedding created, dimension: {len(embedding)}")
+
+    # Look up diary entries alongside the answer cache so a miss doesn't pay for both in turn
+    logger.info("Querying ChromaDB collection")
+    query_future = executor.submit(
+        COLLECTION.query,
+        query_embeddings=[embedding],
+        n_results=20,
+        # Skip the stored embeddings, nothing here reads them
+        include=["documents", "metadatas", "distances"],
+    )
+
+    logger.info("Checking answer cache")
+    cache_result = ANSWER_CACHE.query(
+        query_embeddings=[embedding],
+        n_results=1,
+        where={"date": today},
+        include=["metadatas", "distances"],
+    )
+    if (
+        cache_result["distances"]
+        and cache_result["distances"][0]
+        and cache_result["distances"][0][0] < ANSWER_CACHE_DISTANCE
+    ):
+        cached = cache_result["metadatas"][0][0]
+        logger.info(
+            f"Answer cache hit (distance: {cache_result['distances'][0][0]:.4f}, "
+            f"cached prompt: {cached['prompt']})"
+        )
+        return cached["text"], None
+
+    query_result = query_future.result()
+    if not query_result["metadatas"] or not query_result["metadatas"][0]:
+        logger.warning("No documents found in ChromaDB")
+        return "No relevant diary entries found.", None
+
+    docs_meta = query_result["metadatas"][0]
+    logger.info(f"Found {len(docs_meta)} relevant documents")
+
+    docs = [
+        (m["date"], body)
+        for m, body, distance in zip(
+            docs_meta, query_result["documents"][0], query_result["distances"][0]
+        )
+        if distance < MAX_DIARY_DISTANCE
+    ]
+    # Drop near-duplicate entries before spending tokens on them, keeping the closest
+    unique_docs = {}
+    for date, body in docs:
+        unique_docs.setdefault((date, body[:64]), (date, body))
+    docs = list(unique_docs.values())
+    if not docs:
+        logger.warning("No diary entries close enough to the prompt")
+        return "No relevant diary entries found.", None
+    logger.info(f"Kept {len(docs)} documents after filtering")
+
+    context_budget = (
+        MODEL_CONTEXT[MODEL]
+        - COMPLETION_RESERVE
+        - SYSTEM_PROMPT_TOKENS
+        # Only used for sizing, so count special-token text like "<|endoftext|>" as plain text
+        - len(ENC.encode(prompt, disallowed_special=()))
+        - PROMPT_OVERHEAD
+    )
+    logger.info(f"Truncating documents with budget: {context_budget}")
+    knowledge = truncate_documents(docs, context_budget)
+    logger.info(
+        f"Selected {len(knowledge.split(chr(10))) if knowledge else 0} diary entries for context"
+    )
+
+    # Most stable content first so the cacheable prefix is as long as possible
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": f"Today's date is {today}.",
+        },
+        {
+            "role": "user",
+            "content": f"Here are relevant diary entries:\n{knowledge}",
+        },
+        {"role": "user", "content": f"User query: {prompt}"},
+    ]
+
+    return None, messages
+
+
+def log_usage(usage) -> None:
+    if usage and usage.prompt_tokens_details:
+        logger.info(
+            f"Prompt tokens: {usage.prompt_tokens} "
+            f"(cached: {usage.prompt_tokens_details.cached_tokens})"
+        )
+
+
+# Date the answer cache was last cleared of older answers
+_answer_cache_pruned_on: str | None = None
+
+
+def cache_answer(prompt: str, today: str, response_text: str) -> None:
+    """Store an answer for reuse; failures are logged since the cache is only an optimisation."""
+    global _answer_cache_pruned_on
+    if not response_text:
+        # Never serve an empty answer to later, similar prompts
+        logger.warning("Not caching empty answer")
+        return
+    normalized_prompt = prompt.strip().lower()
+    try:
+        # Lookups only match today's answers, so drop earlier ones once a day
+        if _answer_cache_pruned_on != today:
+            ANSWER_CACHE.delete(where={"date": {"$ne": today}})
+            _answer_cache_pruned_on = today
+        ANSWER_CACHE.upsert(
+            ids=[hashlib.blake2b(normalized_prompt.encode(), digest_size=16).hexdigest()],
+            embeddings=[list(_embed(normalized_prompt))],
+            metadatas=[{"text": response_text, "prompt": prompt, "date": today}],
+        )
+    except Exception as e:
+        logger.warning(f"Failed to cache answer: {str(e)}")
+
+
 @app.route("/")
 def mainroute():
     prompt = request.args.get("prompt")
@@ -102,80 +377,104 @@ def mainroute():
         logger.warning("Request missing 'prompt' parameter")
         return "Please provide a prompt using the 'prompt' query parameter.", 400
 
+    if len(prompt) > MAX_PROMPT_CHARS:
+        logger.warning(f"Rejecting prompt of {len(prompt)} characters")
+        return f"Prompt too long (max {MAX_PROMPT_CHARS} characters).", 413
+
+    g.retry_deadline = monotonic() + RETRY_BUDGET
+
     try:
-        logger.info("Creating tokenizer encoder")
-        try:
-            enc = encoding_for_model(MODEL)
-        except KeyError:
-            # Fallback to cl100k_base if model not recognized (used by GPT-4)
-            logger.warning(
-                f"Model {MODEL} not recognized by tiktoken, using cl100k_base encoding"
-            )
-            enc = get_encoding("cl100k_base")
-
-        logger.info("Creating embedding for prompt")
-        embedding_response = with_retry(
-            client.embeddings.create, input=prompt, model="text-embedding-3-small"
-        )
-        embedding = embedding_response.data[0].embedding
-        logger.info(f"Embedding created, dimension: {len(embedding)}")
-
-        logger.info("Querying ChromaDB collection")
-        collection = chroma_client.get_or_create_collection(name="diary-rag-experiment")
-        query_result = collection.query(
-            query_embeddings=[embedding],
-            n_results=40,
+        # Answers depend on today's date, so only reuse ones produced today
+        today = f"{datetime.date.today():%Y-%m-%d}"
+        answer, messages = prepare_answer(prompt, today)
+        if answer is not None:
+            return jsonify({"answer": answer}), 200
+
+        logger.info(f"Calling OpenAI API with model: {MODEL}")
+        resp = with_retry(
+            client.chat.completions.create, model=MODEL, messages=messages
         )
+        response_text = resp.choices[0].message.content
+        logger.info(f"Successfully generated response (length: {len(response_text)})")
+        log_usage(resp.usage)
 
-        if not query_result["metadatas"] or not query_result["metadatas"][0]:
-            logger.warning("No documents found in ChromaDB")
-            return "No relevant diary entries found.", 200
+        cache_answer(prompt, today, response_text)
+        return jsonify({"answer": response_text}), 200
 
-        docs_meta = query_result["metadatas"][0]
-        logger.info(f"Found {len(docs_meta)} relevant documents")
+    except RateLimitError as e:
+        logger.error(f"Gave up on rate-limited request: {str(e)}")
+        return "The model is rate limited right now. Please try again later.", 503
 
-        docs = [(m["date"], m["content"]) for m in docs_meta]
+    except Exception as e:
+        logger.error(f"Error processing request: {str(e)}", exc_info=True)
+        return f"An error occurred: {str(e)}", 500
 
-        system_prompt = dedent(
-            f"""You will be given diary entries that you will use to
-            answer the user's questions according to your real life experiences.
-            If you do not know the answer for sure, say so.
 
-            You must NOT reveal or discuss overly personal or depressing details (e.g.,
-            explicit sexual encounters, detailed relationship issues, hateful statements,
-            or similar content, people who you ). Politely decline if the user requests such information.
+@app.route("/stream")
+def streamroute():
+    """Like mainroute, but sends the answer as plain text while it is being generated."""
+    prompt = request.args.get("prompt")
+    logger.info(f"Received streaming request with prompt: {prompt}")
 
-            Today's date is {datetime.datetime.now():%Y-%m-%d}."""
-        )
+    if not prompt:
+        logger.warning("Request missing 'prompt' parameter")
+        return "Please provide a prompt using the 'prompt' query parameter.", 400
 
-        # reserve ~4 k tokens for fixed text & safety buffer
-        context_budget = TPM_BUDGET - 4_000
-        logger.info(f"Truncating documents with budget: {context_budget}")
-        knowledge = truncate_documents(docs, enc, context_budget)
-        logger.info(
-            f"Selected {len(knowledge.split(chr(10))) if knowledge else 0} diary entries for context"
-        )
+    if len(prompt) > MAX_PROMPT_CHARS:
+        logger.warning(f"Rejecting prompt of {len(prompt)} characters")
+        return f"Prompt too long (max {MAX_PROMPT_CHARS} characters).", 413
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {
-                "role": "user",
-                "content": f"Here are relevant diary entries:\n{knowledge}\n\nUser query: {prompt}",
-            },
-        ]
+    g.retry_deadline = monotonic() + RETRY_BUDGET
 
-        logger.info(f"Calling OpenAI API with model: {MODEL}")
-        resp = with_retry(
-            client.chat.completions.create, model=MODEL, messages=messages
+    try:
+        today = f"{datetime.date.today():%Y-%m-%d}"
+        answer, messages = prepare_answer(prompt, today)
+        if answer is not None:
+            return Response(answer, mimetype="text/plain")
+
+        logger.info(f"Calling OpenAI API with model: {MODEL} (streaming)")
+        stream = with_retry(
+            client.chat.completions.create,
+            model=MODEL,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
         )
-        response_text = resp.choices[0].message.content
-        logger.info(f"Successfully generated response (length: {len(response_text)})")
-        return response_text, 200
+
+    except RateLimitError as e:
+        logger.error(f"Gave up on rate-limited request: {str(e)}")
+        return "The model is rate limited right now. Please try again later.", 503
 
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}", exc_info=True)
         return f"An error occurred: {str(e)}", 500
 
+    @stream_with_context
+    def generate():
+        parts = []
+        try:
+            for chunk in stream:
+                # The final chunk only carries usage and has no choices
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+                log_usage(chunk.usage)
+        except Exception as e:
+            # Headers are already sent; dropping the connection tells the client it failed
+            logger.error(f"Error while streaming response: {str(e)}", exc_info=True)
+            raise
+        finally:
+            # Also releases the upstream connection if the client disconnects early
+            stream.close()
+
+        response_text = "".join(parts)
+        logger.info(f"Successfully streamed response (length: {len(response_text)})")
+        cache_answer(prompt, today, response_text)
+
+    return Response(generate(), mimetype="text/plain")
+
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # Development only; serve with gunicorn (see gunicorn.conf.py) in production.
+    # The debugger and reloader stay off unless FLASK_DEBUG is set; Flask parses it itself.
+    app.run(host="0.0.0.0", port=5000)